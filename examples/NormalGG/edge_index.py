@@ -1,84 +1,307 @@
+import hashlib
+from collections import OrderedDict
+
 import numpy as np
 from scipy.sparse import csr_matrix
 import pandas as pd
 import h5py
 
-def generate_edge_index(rve_size, grain_distribution, include_self_loops=False):
-    """
-    生成 edge_index 表示的图结构。
-    """
-    nx, ny, nz = rve_size
-    gx, gy, gz = grain_distribution
-    grain_size = (nx // gx, ny // gy, nz // gz)
-    
-    # 构建晶粒分布
-    grain_map = np.zeros((nx, ny, nz), dtype=int)
-    grain_id = 0
-    for i in range(0, nx, grain_size[0]):
-        for j in range(0, ny, grain_size[1]):
-            for k in range(0, nz, grain_size[2]):
-                grain_map[i:i + grain_size[0], j:j + grain_size[1], k:k + grain_size[2]] = grain_id
-                grain_id += 1
-
-    # 构建邻接关系（edge_index）
-    node_count = gx * gy * gz
-    adjacency_list = []
+try:
+    from numba import njit, prange
+except ImportError:  # Numba 为可选依赖，未安装时退回向量化的 _slice_edges
+    njit = None
+    prange = range
+
+try:
+    import hdf5plugin
+except ImportError:  # hdf5plugin 为可选依赖，仅 compression="blosc2" 时需要
+    hdf5plugin = None
 
-    def get_linear_index(x, y, z):
-        return x * gy * gz + y * gz + z
 
-    for x in range(gx):
+def _fill_edges(gx, gy, gz, row_out, col_out, include_self):
+    """
+    逐晶粒检查 6-邻域，将边直接写入预分配的 row_out / col_out。
+    邻居按编号从小到大写入，结果已按 (row, col) 排序。
+    各 x 层的写入起点可解析得到，因此最外层循环可用 prange 并行。
+    """
+    # 每个 x 层内 y、z 方向的边数（含自环），x 方向的边数取决于该层是否在边界上
+    slab = gy * gz
+    inner = 2 * (gy - 1) * gz + 2 * gy * (gz - 1)
+    if include_self:
+        inner += slab
+    for x in prange(gx):
+        idx = x * inner + slab * (max(x - 1, 0) + x)
         for y in range(gy):
             for z in range(gz):
-                current_node = get_linear_index(x, y, z)
-                neighbors = []
+                current = x * gy * gz + y * gz + z
 
-                # 检查 6-邻域
                 if x > 0:  # 左
-                    neighbors.append(get_linear_index(x - 1, y, z))
-                if x < gx - 1:  # 右
-                    neighbors.append(get_linear_index(x + 1, y, z))
+                    row_out[idx] = current
+                    col_out[idx] = current - gy * gz
+                    idx += 1
                 if y > 0:  # 前
-                    neighbors.append(get_linear_index(x, y - 1, z))
-                if y < gy - 1:  # 后
-                    neighbors.append(get_linear_index(x, y + 1, z))
+                    row_out[idx] = current
+                    col_out[idx] = current - gz
+                    idx += 1
                 if z > 0:  # 下
-                    neighbors.append(get_linear_index(x, y, z - 1))
+                    row_out[idx] = current
+                    col_out[idx] = current - 1
+                    idx += 1
+
+                # 添加自环
+                if include_self:
+                    row_out[idx] = current
+                    col_out[idx] = current
+                    idx += 1
+
                 if z < gz - 1:  # 上
-                    neighbors.append(get_linear_index(x, y, z + 1))
+                    row_out[idx] = current
+                    col_out[idx] = current + 1
+                    idx += 1
+                if y < gy - 1:  # 后
+                    row_out[idx] = current
+                    col_out[idx] = current + gz
+                    idx += 1
+                if x < gx - 1:  # 右
+                    row_out[idx] = current
+                    col_out[idx] = current + gy * gz
+                    idx += 1
 
-                for neighbor in neighbors:
-                    adjacency_list.append((current_node, neighbor))
 
-                # 添加自环
-                if include_self_loops:
-                    adjacency_list.append((current_node, current_node))
+if njit is not None:
+    _fill_edges = njit(cache=True, parallel=True)(_fill_edges)
 
-    # 转换为稀疏矩阵形式的边列表
-    rows, cols = zip(*adjacency_list)
-    edge_index = (np.array(rows, dtype=int), np.array(cols, dtype=int))
+
+def _slice_edges(gx, gy, gz, rows, cols, include_self):
+    """
+    未安装 Numba 时的向量化实现：按编号从小到大的方向依次将邻居写入预分配的 rows / cols。
+    每个晶粒的边在 CSR 中的位置可由各晶粒的边数前缀和得到，写入后即为 (row, col) 排序，无需再排序。
+    """
+    # 构建邻接关系（edge_index）：晶粒编号 x * gy * gz + y * gz + z
+    ids = np.arange(gx * gy * gz, dtype=np.int32).reshape(gx, gy, gz)
+
+    # 各晶粒的边数（内部晶粒为 6，边界上减少），其前缀和即为各晶粒第一条边的写入位置
+    counts = np.full((gx, gy, gz), 7 if include_self else 6, dtype=np.int64)
+    counts[0] -= 1
+    counts[-1] -= 1
+    counts[:, 0] -= 1
+    counts[:, -1] -= 1
+    counts[:, :, 0] -= 1
+    counts[:, :, -1] -= 1
+    cursor = np.cumsum(counts.ravel()).reshape(counts.shape)
+    cursor -= counts
+    del counts
+
+    # 方向按偏移从小到大：左、前、下、（自环）、上、后、右，每个方向只处理有该邻居的晶粒（一个切片）
+    directions = [
+        ((slice(1, None), slice(None), slice(None)), -gy * gz),  # 左
+        ((slice(None), slice(1, None), slice(None)), -gz),  # 前
+        ((slice(None), slice(None), slice(1, None)), -1),  # 下
+        ((slice(None), slice(None), slice(None, -1)), 1),  # 上
+        ((slice(None), slice(None, -1), slice(None)), gz),  # 后
+        ((slice(None, -1), slice(None), slice(None)), gy * gz),  # 右
+    ]
+    if include_self:
+        directions.insert(3, ((slice(None), slice(None), slice(None)), 0))  # 自环
+
+    for region, offset in directions:
+        src = ids[region]
+        pos = cursor[region]
+        rows[pos] = src
+        cols[pos] = src + offset
+        cursor[region] += 1
+    return rows, cols
+
+
+# generate_edge_index 的结果缓存：{(grain_distribution, include_self_loops, use_numba): (row, col)}
+# 按数组总字节数限制大小，超过上限的单个结果不缓存
+_EDGE_INDEX_CACHE = OrderedDict()
+_EDGE_INDEX_CACHE_BYTES = 256 << 20
+
+
+def _build_edge_index(grain_distribution, include_self_loops, use_numba):
+    """
+    generate_edge_index 的实际实现（不经过缓存）。
+    """
+    gx, gy, gz = grain_distribution
+    node_count = gx * gy * gz
+
+    # 边数可解析得到，直接预分配边列表
+    n_edges = 6 * node_count - 2 * (gy * gz + gx * gz + gx * gy)
+    if include_self_loops:
+        n_edges += node_count
+    rows = np.empty(n_edges, dtype=np.int32)
+    cols = np.empty(n_edges, dtype=np.int32)
+
+    if use_numba:
+        if njit is None:
+            raise ImportError("Numba not installed. Install with: pip install numba")
+        _fill_edges(gx, gy, gz, rows, cols, include_self_loops)
+        return rows, cols
+    return _slice_edges(gx, gy, gz, rows, cols, include_self_loops)
+
+
+def _cache_edge_index(key, edge_index):
+    """
+    将生成的 edge_index 加入缓存并返回；缓存的数组在多次调用间共享，设为只读。
+    缓存超过 _EDGE_INDEX_CACHE_BYTES 时淘汰最久未使用的结果。
+    """
+    for array in edge_index:
+        array.flags.writeable = False
+    size = sum(array.nbytes for array in edge_index)
+    if size > _EDGE_INDEX_CACHE_BYTES:
+        return edge_index
+    _EDGE_INDEX_CACHE[key] = edge_index
+    cached = sum(array.nbytes for value in _EDGE_INDEX_CACHE.values() for array in value)
+    while cached > _EDGE_INDEX_CACHE_BYTES:
+        _, evicted = _EDGE_INDEX_CACHE.popitem(last=False)
+        cached -= sum(array.nbytes for array in evicted)
     return edge_index
 
 
-def save_edge_index_to_hdf5(edge_index, filename):
+def _edge_index_key(grain_distribution, include_self_loops, use_numba):
+    # use_numba=None：安装了 Numba 时使用 _fill_edges
+    if use_numba is None:
+        use_numba = njit is not None
+    return tuple(grain_distribution), bool(include_self_loops), bool(use_numba)
+
+
+def generate_edge_index(rve_size, grain_distribution, include_self_loops=False, use_numba=None):
+    """
+    生成 edge_index 表示的图结构。
+    邻接关系只取决于晶粒分布 grain_distribution，rve_size 仅为保持接口不变。
+    默认（use_numba=None）在安装了 Numba 时使用编译的逐晶粒并行循环（_fill_edges）直接写入，否则使用 _slice_edges；
+    use_numba=True / False 可强制选择其中一种，两者结果相同。
+    返回的边按 (row, col) 排序，即 CSR 顺序。
+    结果为只读数组；相同晶粒分布的结果会被缓存（总计不超过 _EDGE_INDEX_CACHE_BYTES），
+    重复调用直接返回同一对数组（需要修改时请先 copy）。
+    """
+    return _edge_index(_edge_index_key(grain_distribution, include_self_loops, use_numba))
+
+
+def _edge_index(key):
+    """
+    从缓存中取出 key 对应的 edge_index，不存在时生成并加入缓存。
+    """
+    if key in _EDGE_INDEX_CACHE:
+        _EDGE_INDEX_CACHE.move_to_end(key)
+        return _EDGE_INDEX_CACHE[key]
+    return _cache_edge_index(key, _build_edge_index(*key))
+
+
+def _edge_compression(compression="lzf"):
+    """
+    row/col 数据集的压缩参数：默认使用 h5py 自带的 LZF，任何读取端都能直接读取；
+    compression="blosc2" 时使用 Blosc2（zstd + bitshuffle），需要安装 hdf5plugin。
+    """
+    if compression == "blosc2":
+        if hdf5plugin is None:
+            raise ImportError("hdf5plugin not installed. Install with: pip install hdf5plugin")
+        return dict(hdf5plugin.Blosc2(cname="zstd", clevel=3, filters=hdf5plugin.Blosc2.BITSHUFFLE))
+    return {"compression": compression}
+
+
+def _write_edge_attrs(group, edge_index, n_nodes=None):
+    """
+    写入 n_edges / n_nodes（给出时）及排序标记，读取端无需读取数据即可分配缓冲区。
+    """
+    group.attrs["n_edges"] = edge_index[0].shape[0]
+    if n_nodes is not None:
+        group.attrs["n_nodes"] = n_nodes
+    # 标记边已按源节点排序，读取端可据此跳过排序
+    if np.all(edge_index[0][1:] >= edge_index[0][:-1]):
+        group.attrs["sorted_by"] = "row"
+
+
+def _write_edge_group(group, edge_index, n_nodes=None, compression="lzf"):
     """
-    将 edge_index 保存为 HDF5 文件。
+    在 group 下写入 row / col 数据集（int32）及其属性。
     """
+    compression = _edge_compression(compression)
+    # 读取端总是整体读取，按约 1 MB（int32）一个 chunk 划分，小图即为单个 chunk；没有边时交给 h5py 决定
+    n = edge_index[0].shape[0]
+    chunks = (min(n, 1_048_576 // 4),) if n else None
+    group.create_dataset("row", data=edge_index[0], dtype=np.int32, chunks=chunks, **compression)
+    group.create_dataset("col", data=edge_index[1], dtype=np.int32, chunks=chunks, **compression)
+    _write_edge_attrs(group, edge_index, n_nodes)
+
+
+def _topology_key(edge_index):
+    """
+    edge_index 的拓扑键 (n_edges, 摘要)：按写入时的 int32 内容计算，相同拓扑的时间步键相同。
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for array in edge_index:
+        digest.update(np.ascontiguousarray(array, dtype=np.int32))
+    return edge_index[0].shape[0], digest.digest()
+
+
+def save_edge_index_to_hdf5(edge_index, filename, n_nodes=None, compression="lzf"):
+    """
+    将 edge_index 保存为 HDF5 文件（int32）。
+    边数和节点数（n_nodes 给出时）记录为 n_edges / n_nodes 属性，读取端无需读取数据即可分配缓冲区。
+    compression="blosc2" 压缩率更高，但读取端同样需要安装 hdf5plugin。
+    """
+    with h5py.File(filename, "w") as f:
+        _write_edge_group(f.create_group("edge_index"), edge_index, n_nodes, compression)
+
+
+def save_edge_index_timesteps_to_hdf5(edge_indices, filename, n_nodes=None, compression="lzf"):
+    """
+    将多个时间步的 edge_index（{timestep: (row, col)}）保存为 /CheckPoints/EdgeIndex/{timestep}/row 和 col，
+    与 MicrostructureAnalysis 写出的结构一致。
+    n_nodes 为 {timestep: 节点数}，各时间步的拓扑可能不同，未给出的时间步不写 n_nodes 属性。
+    拓扑与之前某个时间步相同时只创建指向已写入数据集的硬链接，不重复写入数据。
+    """
+    if n_nodes is None:
+        n_nodes = {}
+    elif not isinstance(n_nodes, dict):
+        raise TypeError("n_nodes must be a dict of {timestep: n_nodes}")
+    # {拓扑键: 已写入的组}，只保存组句柄，不保留边数组；每个时间步只需计算一次摘要
+    written = {}
+    # 缓存返回的同一对数组无需重复计算摘要（edge_indices 在写入期间保持这些数组存活）
+    keys = {}
     with h5py.File(filename, "w") as f:
-        f.create_dataset("edge_index/row", data=edge_index[0], compression="gzip")
-        f.create_dataset("edge_index/col", data=edge_index[1], compression="gzip")
+        root = f.create_group("/CheckPoints/EdgeIndex")
+        for timestep, edge_index in edge_indices.items():
+            group = root.create_group(str(timestep))
+            nodes = n_nodes.get(timestep)
+            ids = (id(edge_index[0]), id(edge_index[1]))
+            if ids not in keys:
+                keys[ids] = _topology_key(edge_index)
+            previous_group = written.get(keys[ids])
+            if previous_group is not None:
+                group["row"] = previous_group["row"]
+                group["col"] = previous_group["col"]
+                _write_edge_attrs(group, edge_index, nodes)
+            else:
+                _write_edge_group(group, edge_index, nodes, compression)
+                written[keys[ids]] = group
+
+
+def generate_edge_indices(rve_size, grain_distributions, include_self_loops=False, use_numba=None):
+    """
+    为多个时间步（各自的晶粒分布）生成 edge_index，返回与 grain_distributions 一一对应的列表。
+    相同的晶粒分布只生成一次，结果与 generate_edge_index 相同；安装了 Numba 时由 _fill_edges 多线程生成。
+    """
+    keys = [_edge_index_key(d, include_self_loops, use_numba) for d in grain_distributions]
+    by_key = {key: _edge_index(key) for key in dict.fromkeys(keys)}
+    return [by_key[key] for key in keys]
+
 
-# 参数设置
-rve_size = (30, 30, 30)  # RVE 的单元尺寸
-grain_distribution = (15, 15, 15)  # 晶粒分布
-include_self_loops = True  # 是否包含自环
+if __name__ == "__main__":
+    # 参数设置
+    rve_size = (30, 30, 30)  # RVE 的单元尺寸
+    grain_distribution = (15, 15, 15)  # 晶粒分布
+    include_self_loops = True  # 是否包含自环
 
-# 生成 edge_index
-edge_index = generate_edge_index(rve_size, grain_distribution, include_self_loops)
+    # 生成 edge_index
+    edge_index = generate_edge_index(rve_size, grain_distribution, include_self_loops)
 
-# 保存到 CSV 文件和 HDF5 文件
-hdf5_filename = "edge_index.hdf5"
-save_edge_index_to_hdf5(edge_index, hdf5_filename)
+    # 保存到 CSV 文件和 HDF5 文件
+    hdf5_filename = "edge_index.hdf5"
+    n_nodes = grain_distribution[0] * grain_distribution[1] * grain_distribution[2]
+    save_edge_index_to_hdf5(edge_index, hdf5_filename, n_nodes)
 
-# 打印结果
-print(f"Edge index 已保存为 HDF5 文件：{hdf5_filename}")
+    # 打印结果
+    print(f"Edge index 已保存为 HDF5 文件：{hdf5_filename}")
@@ -2,35 +2,293 @@
 """
 示例：如何使用HDF5文件中的EdgeIndex数据进行机器学习/图神经网络
 """
+import os
+import threading
+from queue import Full, Queue
+
 import h5py
 import numpy as np
 
-def load_graph_data(h5_file: str, timestep: int):
+try:
+    import hdf5plugin  # noqa: F401  注册 Blosc2 等过滤器，读取 compression="blosc2" 写出的文件
+except ImportError:  # hdf5plugin 为可选依赖
+    pass
+
+try:
+    from torch_geometric.data import Dataset as _GeometricDataset
+except ImportError:  # PyTorch Geometric 为可选依赖，仅 GrainGraphDataset 需要
+    _GeometricDataset = object
+
+# HDF5 chunk 缓存：遍历多个时间步时让缓存容纳工作集（默认仅 1 MB / 521 槽）
+_CHUNK_CACHE = {'rdcc_nbytes': 64 << 20, 'rdcc_nslots': 10007}
+
+def list_available_timesteps(h5_file: str, dataset_name: str = "EdgeIndex"):
+    """列出可用的时间步"""
+    with h5py.File(h5_file, 'r') as f:
+        grp = f'/CheckPoints/{dataset_name}'
+        if grp not in f:
+            raise ValueError(f"Group {grp} not found in HDF5 file: {h5_file}")
+        return sorted(int(k) for k in f[grp].keys())
+
+def _read_dataset(dset, dtype=None, out=None):
     """
-    从HDF5文件加载图数据，返回适用于PyTorch Geometric的格式
+    用 read_direct 将数据集直接读入预分配的数组
+    out 缺省时新建数组（dtype 默认与数据集一致）；out 必须是 C 连续的，也可以是 CPU 上的 torch 张量
+    """
+    if out is None:
+        out = np.empty(dset.shape, dtype=dset.dtype if dtype is None else dtype)
+    buf = np.asarray(out)
+    if buf.size:
+        dset.read_direct(buf)
+    return out
+
+def _torch_empty(shape, dtype):
+    """
+    分配 torch 张量作为读取缓冲区；有GPU时使用页锁定（pinned）内存，可用 non_blocking=True 异步拷贝到GPU
+    """
+    import torch
+    torch_dtype = torch.from_numpy(np.empty(0, dtype=dtype)).dtype
+    return torch.empty(shape, dtype=torch_dtype, pin_memory=torch.cuda.is_available())
+
+# 各数据所在的组
+_GRAPH_GROUPS = {
+    'edge_index': "/CheckPoints/EdgeIndex",
+    'volumes': "/CheckPoints/GrainVolumes",
+    'neighbors': "/CheckPoints/GrainNeighbors",
+}
+
+class _GraphGroups(dict):
+    """各数据所在的组，首次访问时才解析并缓存；只用到边数据时不要求节点特征组存在"""
+    def __init__(self, f):
+        super().__init__()
+        self._file = f
+    
+    def __missing__(self, key):
+        group = self[key] = self._file[_GRAPH_GROUPS[key]]
+        return group
+
+def _open_graph_groups(f):
+    """
+    解析一次各数据所在的组（按需），遍历多个时间步时重复使用
+    """
+    return _GraphGroups(f)
+
+def _graph_sizes(groups: dict, timestep: int):
+    """
+    只根据元数据得到 (num_nodes, num_edges)：优先使用 n_nodes / n_edges 属性，缺少属性时才打开数据集取其形状
+    """
+    edge_group = groups['edge_index'][f"{timestep}"]
+    attrs = edge_group.attrs
+    if 'n_nodes' in attrs:
+        num_nodes = attrs['n_nodes']
+    else:
+        num_nodes = groups['volumes'][f"{timestep}"].shape[0]
+    if 'n_edges' in attrs:
+        num_edges = attrs['n_edges']
+    else:
+        num_edges = edge_group['row'].shape[0]
+    return int(num_nodes), int(num_edges)
+
+def read_graph_sizes(h5_file: str, timestep: int):
+    """
+    读取图的节点数和边数 (num_nodes, num_edges)，不读取数据本身，可用于预先分配缓冲区
     """
     with h5py.File(h5_file, 'r') as f:
-        # 读取边列表
-        edge_row = f[f"/CheckPoints/EdgeIndex/{timestep}/row"][:]
-        edge_col = f[f"/CheckPoints/EdgeIndex/{timestep}/col"][:]
-        
-        # 读取节点特征（晶粒体积和邻居数）
-        grain_volumes = f[f"/CheckPoints/GrainVolumes/{timestep}"][:]
-        grain_neighbors = f[f"/CheckPoints/GrainNeighbors/{timestep}"][:]
+        return _graph_sizes(_open_graph_groups(f), timestep)
+
+def _read_graph(groups: dict, timestep: int, allocate=np.empty):
+    """
+    从已解析的组中读取一个时间步的图数据
+    """
+    num_nodes, num_edges = _graph_sizes(groups, timestep)
     
-    # 构建edge_index (2, num_edges) 格式，适用于PyTorch Geometric
-    edge_index = np.stack([edge_row, edge_col], axis=0)
+    # 读取边列表，直接写入 edge_index (2, num_edges) 的两行，适用于PyTorch Geometric
+    # 节点编号以 int32 保存和传输，只在交给PyG时转换为 int64
+    row_dset = groups['edge_index'][f"{timestep}/row"]
+    col_dset = groups['edge_index'][f"{timestep}/col"]
+    edge_index = allocate((2, num_edges), dtype=np.int32)
+    _read_dataset(row_dset, out=edge_index[0])
+    _read_dataset(col_dset, out=edge_index[1])
     
-    # 构建节点特征矩阵 (num_nodes, num_features)
-    node_features = np.stack([grain_volumes, grain_neighbors], axis=1)
+    # 边是否已按源节点排序：优先使用文件中的标记，否则直接检查
+    sorted_by = groups['edge_index'][f"{timestep}"].attrs.get('sorted_by')
+    if sorted_by is None:
+        row = np.asarray(edge_index[0])
+        sorted_by = 'row' if np.all(row[1:] >= row[:-1]) else None
+    
+    # 读取节点特征（晶粒体积和邻居数），按特征逐行写入 (2, num_nodes)
+    volume_dset = groups['volumes'][f"{timestep}"]
+    neighbors_dset = groups['neighbors'][f"{timestep}"]
+    features = allocate((2, num_nodes), dtype=np.float32)
+    _read_dataset(volume_dset, out=features[0])
+    _read_dataset(neighbors_dset, out=features[1])
+    
+    # 节点特征矩阵 (num_nodes, num_features)，为转置视图，不再拷贝
+    node_features = features.T
     
     return {
         'edge_index': edge_index,
         'node_features': node_features,
-        'num_nodes': len(grain_volumes),
-        'num_edges': len(edge_row)
+        'num_nodes': num_nodes,
+        'num_edges': num_edges,
+        'sorted_by': sorted_by
     }
 
+def load_graph_data(h5_file: str, timestep: int, allocate=np.empty):
+    """
+    从HDF5文件加载图数据，返回适用于PyTorch Geometric的格式
+    allocate(shape, dtype) 用于分配输出缓冲区，默认 np.empty；传入 _torch_empty 时直接读入 torch 张量
+    """
+    with h5py.File(h5_file, 'r', **_CHUNK_CACHE) as f:
+        return _read_graph(_open_graph_groups(f), timestep, allocate)
+
+def iter_graph_data(h5_file: str, timesteps=None, allocate=np.empty):
+    """
+    依次加载多个时间步（默认全部）的图数据，逐个产生 (timestep, data)
+    整个遍历只打开一次文件、只解析一次组路径
+    """
+    with h5py.File(h5_file, 'r', **_CHUNK_CACHE) as f:
+        groups = _open_graph_groups(f)
+        if timesteps is None:
+            timesteps = sorted(int(k) for k in groups['edge_index'].keys())
+        for timestep in timesteps:
+            yield timestep, _read_graph(groups, timestep, allocate)
+
+def _as_edge_index(edge_index, num_nodes: int, sorted_by=None):
+    """
+    包装为 torch_geometric.EdgeIndex 并带上排序信息，使PyG在消息传递/CSR转换时跳过排序
+    PyG < 2.5 没有 EdgeIndex，此时原样返回
+    """
+    try:
+        from torch_geometric import EdgeIndex
+    except ImportError:
+        return edge_index
+    return EdgeIndex(edge_index, sparse_size=(num_nodes, num_nodes), sort_order=sorted_by)
+
+class GrainGraphPrefetcher:
+    """
+    多时间步训练时的双缓冲预取：后台线程把各时间步读入页锁定内存，
+    主线程在独立的CUDA流上异步拷贝到GPU，计算流通过事件等待拷贝完成。
+    迭代得到 (timestep, x, edge_index)，x 为 (num_nodes, 2) 的节点特征。
+    """
+    def __init__(self, h5_file: str, timesteps, device=None, depth: int = 2):
+        import torch
+        self.h5_file = h5_file
+        self.timesteps = list(timesteps)
+        self.device = torch.device(device if device is not None else
+                                   ('cuda' if torch.cuda.is_available() else 'cpu'))
+        self.depth = depth
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+    
+    def __len__(self):
+        return len(self.timesteps)
+    
+    def _load(self, queue: Queue, stop: threading.Event):
+        """后台线程：依次读取各时间步，队列已满时阻塞；结束时放入 None；stop 被设置时关闭文件并退出"""
+        def put(item):
+            # 带超时地放入队列，消费端提前停止迭代时不会永远阻塞
+            while not stop.is_set():
+                try:
+                    queue.put(item, timeout=0.1)
+                    return True
+                except Full:
+                    pass
+            return False
+        
+        try:
+            for item in iter_graph_data(self.h5_file, self.timesteps, allocate=_torch_empty):
+                if not put(item):
+                    return  # 退出 with 块，关闭文件
+        except Exception as e:
+            put(e)
+            return
+        put(None)
+    
+    def _next(self, queue: Queue):
+        """取出下一个时间步并在拷贝流上发起异步拷贝，返回 (timestep, x, edge_index, event)"""
+        import torch
+        item = queue.get()
+        if item is None:
+            return None
+        if isinstance(item, Exception):
+            raise item
+        
+        timestep, data = item
+        if self.stream is None:
+            return timestep, data['node_features'], data['edge_index'].long(), None
+        
+        with torch.cuda.stream(self.stream):
+            x = data['node_features'].T.to(self.device, non_blocking=True).t().contiguous()
+            edge_index = data['edge_index'].to(self.device, non_blocking=True).long()
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return timestep, x, edge_index, event
+    
+    def __iter__(self):
+        import torch
+        queue = Queue(maxsize=self.depth)
+        stop = threading.Event()
+        loader = threading.Thread(target=self._load, args=(queue, stop), daemon=True)
+        loader.start()
+        
+        try:
+            pending = self._next(queue)
+            while pending is not None:
+                timestep, x, edge_index, event = pending
+                # 先发起下一个时间步的拷贝，再交出当前时间步，使拷贝与计算重叠
+                pending = self._next(queue)
+                if event is not None:
+                    stream = torch.cuda.current_stream(self.device)
+                    stream.wait_event(event)
+                    # 张量在拷贝流上分配、在计算流上使用，需告知缓存分配器
+                    x.record_stream(stream)
+                    edge_index.record_stream(stream)
+                yield timestep, x, edge_index
+        finally:
+            # 消费端提前停止（break 或异常）时通知后台线程退出并关闭文件
+            stop.set()
+            loader.join()
+
+class GrainGraphDataset(_GeometricDataset):
+    """
+    按时间步惰性加载的PyTorch Geometric数据集，每个时间步为一个图，
+    配合 torch_geometric.loader.DataLoader 由PyG完成批处理（edge_index偏移拼接）
+    """
+    def __init__(self, h5_file: str, timesteps=None, transform=None):
+        if _GeometricDataset is object:
+            raise ImportError("PyTorch Geometric not installed. Install with: pip install torch-geometric")
+        self.h5_file = h5_file
+        self.timesteps = list_available_timesteps(h5_file) if timesteps is None else list(timesteps)
+        self._file = None
+        self._groups = None
+        self._pid = None
+        super().__init__(None, transform)
+    
+    def __getstate__(self):
+        # 打开的HDF5文件不能传给DataLoader的worker进程
+        state = self.__dict__.copy()
+        state.update(_file=None, _groups=None, _pid=None)
+        return state
+    
+    def _graph_groups(self):
+        """每个（worker）进程只打开一次文件并缓存组句柄"""
+        if self._groups is None or self._pid != os.getpid():
+            self._file = h5py.File(self.h5_file, 'r', **_CHUNK_CACHE)
+            self._groups = _open_graph_groups(self._file)
+            self._pid = os.getpid()
+        return self._groups
+    
+    def len(self):
+        return len(self.timesteps)
+    
+    def get(self, idx):
+        import torch
+        from torch_geometric.data import Data
+        
+        data = _read_graph(self._graph_groups(), self.timesteps[idx])
+        edge_index = _as_edge_index(torch.from_numpy(data['edge_index']).long(), data['num_nodes'], data['sorted_by'])
+        return Data(x=torch.from_numpy(data['node_features']), edge_index=edge_index)
+
 def example_pytorch_geometric_usage(h5_file: str, timestep: int):
     """
     示例：使用PyTorch Geometric加载数据
@@ -38,30 +296,73 @@ def example_pytorch_geometric_usage(h5_file: str, timestep: int):
     try:
         import torch
         from torch_geometric.data import Data
+        from torch_geometric.utils import is_undirected
         
-        data = load_graph_data(h5_file, timestep)
+        # 直接读入（页锁定的）torch 张量，有GPU时再异步拷贝到GPU
+        device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        data = load_graph_data(h5_file, timestep, allocate=_torch_empty)
         
         # 转换为PyTorch Geometric的Data对象
-        graph_data = Data(
-            x=torch.tensor(data['node_features'], dtype=torch.float),
-            edge_index=torch.tensor(data['edge_index'], dtype=torch.long)
-        )
+        # 节点特征以连续的 (2, num_nodes) 缓冲区传输，在目标设备上再转置
+        x = data['node_features'].T.to(device, non_blocking=True).t().contiguous()
+        # 以 int32 传输，在目标设备上再转换为PyG要求的 int64
+        edge_index = data['edge_index'].to(device, non_blocking=True).long()
+        graph_data = Data(x=x, edge_index=_as_edge_index(edge_index, data['num_nodes'], data['sorted_by']))
         
         print(f"\n[PyTorch Geometric] Graph at timestep {timestep}:")
         print(f"  - Number of nodes: {graph_data.num_nodes}")
         print(f"  - Number of edges: {graph_data.num_edges}")
         print(f"  - Node feature dimension: {graph_data.x.shape[1]}")
-        print(f"  - Is undirected: {graph_data.is_undirected()}")
+        print(f"  - Is undirected: {is_undirected(edge_index, num_nodes=graph_data.num_nodes)}")
         print(f"\n  Node features (first 5 grains):")
         print(f"  [Volume, Neighbors]")
         for i in range(min(5, graph_data.num_nodes)):
-            print(f"  Grain {i}: {graph_data.x[i].numpy()}")
+            print(f"  Grain {i}: {graph_data.x[i].cpu().numpy()}")
         
         return graph_data
     except ImportError:
         print("PyTorch Geometric not installed. Install with: pip install torch-geometric")
         return None
 
+def example_prefetch_usage(h5_file: str):
+    """
+    示例：用GrainGraphPrefetcher依次遍历所有时间步（如训练循环）
+    """
+    try:
+        from torch_geometric.data import Data
+        
+        timesteps = list_available_timesteps(h5_file)
+        prefetcher = GrainGraphPrefetcher(h5_file, timesteps)
+        print(f"\n[Prefetch] Iterating {len(prefetcher)} timesteps on {prefetcher.device}:")
+        for timestep, x, edge_index in prefetcher:
+            graph_data = Data(x=x, edge_index=edge_index)
+            print(f"  - Timestep {timestep}: {graph_data.num_nodes} nodes, {graph_data.num_edges} edges")
+        
+        return prefetcher
+    except ImportError:
+        print("PyTorch Geometric not installed. Install with: pip install torch-geometric")
+        return None
+
+def example_dataloader_usage(h5_file: str, batch_size: int = 32):
+    """
+    示例：用GrainGraphDataset + DataLoader 按批加载所有时间步
+    """
+    try:
+        import torch
+        from torch_geometric.loader import DataLoader
+        
+        dataset = GrainGraphDataset(h5_file)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4,
+                            pin_memory=torch.cuda.is_available())
+        print(f"\n[DataLoader] {len(dataset)} timesteps, batch size {batch_size}:")
+        for batch in loader:
+            print(f"  - Batch: {batch.num_graphs} graphs, {batch.num_nodes} nodes, {batch.num_edges} edges")
+        
+        return loader
+    except ImportError:
+        print("PyTorch Geometric not installed. Install with: pip install torch-geometric")
+        return None
+
 def example_networkx_usage(h5_file: str, timestep: int):
     """
     示例：使用NetworkX加载数据
@@ -71,18 +372,17 @@ def example_networkx_usage(h5_file: str, timestep: int):
         
         data = load_graph_data(h5_file, timestep)
         
-        # 创建NetworkX图
+        # 创建NetworkX图，先批量添加全部节点（保留没有邻居的晶粒）
         G = nx.Graph()
+        G.add_nodes_from(range(data['num_nodes']))
         
-        # 添加节点和特征
-        for i in range(data['num_nodes']):
-            G.add_node(i, 
-                      volume=data['node_features'][i, 0],
-                      neighbors=data['node_features'][i, 1])
+        # 批量添加边
+        G.add_edges_from(data['edge_index'].T.tolist())
         
-        # 添加边
-        edges = list(zip(data['edge_index'][0], data['edge_index'][1]))
-        G.add_edges_from(edges)
+        # 批量设置节点特征
+        volumes, neighbors = data['node_features'].T
+        nx.set_node_attributes(G, dict(enumerate(volumes.tolist())), 'volume')
+        nx.set_node_attributes(G, dict(enumerate(neighbors.tolist())), 'neighbors')
         
         print(f"\n[NetworkX] Graph at timestep {timestep}:")
         print(f"  - Number of nodes: {G.number_of_nodes()}")
@@ -102,21 +402,40 @@ def example_networkx_usage(h5_file: str, timestep: int):
 
 def example_save_for_external_tools(h5_file: str, timestep: int, output_prefix: str = "grain_graph"):
     """
-    示例：导出为其他工具可用的格式（CSV、edge list等）
+    示例：导出为其他工具可用的格式（Parquet；未安装 pyarrow 时退回 NumPy 的 .npy）
     """
     data = load_graph_data(h5_file, timestep)
+    source, target = data['edge_index']
+    volumes, neighbors = data['node_features'].T  # (2, num_nodes) 缓冲区的两行，均为连续数组
     
-    # 保存边列表为CSV
-    edge_list_file = f"{output_prefix}_t{timestep}_edges.csv"
-    np.savetxt(edge_list_file, data['edge_index'].T, 
-               delimiter=',', header='source,target', comments='', fmt='%d')
-    print(f"\n[Export] Edge list saved to: {edge_list_file}")
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print("\nPyArrow not installed, exporting .npy files instead. Install with: pip install pyarrow")
+        pa = None
     
-    # 保存节点特征为CSV
-    node_features_file = f"{output_prefix}_t{timestep}_nodes.csv"
-    np.savetxt(node_features_file, data['node_features'], 
-               delimiter=',', header='volume,neighbors', comments='', fmt='%.6e,%d')
-    print(f"[Export] Node features saved to: {node_features_file}")
+    if pa is not None:
+        # 保存边列表为Parquet
+        edge_list_file = f"{output_prefix}_t{timestep}_edges.parquet"
+        pq.write_table(pa.table({'source': source, 'target': target}), edge_list_file, compression='zstd')
+        print(f"\n[Export] Edge list saved to: {edge_list_file}")
+        
+        # 保存节点特征为Parquet
+        node_features_file = f"{output_prefix}_t{timestep}_nodes.parquet"
+        pq.write_table(pa.table({'volume': volumes, 'neighbors': neighbors.astype(np.int32)}),
+                       node_features_file, compression='zstd')
+        print(f"[Export] Node features saved to: {node_features_file}")
+    else:
+        # 保存边列表为 (num_edges, 2) 的 [source, target]
+        edge_list_file = f"{output_prefix}_t{timestep}_edges.npy"
+        np.save(edge_list_file, data['edge_index'].T)
+        print(f"\n[Export] Edge list saved to: {edge_list_file}")
+        
+        # 保存节点特征为 (num_nodes, 2) 的 [volume, neighbors]
+        node_features_file = f"{output_prefix}_t{timestep}_nodes.npy"
+        np.save(node_features_file, data['node_features'])
+        print(f"[Export] Node features saved to: {node_features_file}")
     
     return edge_list_file, node_features_file
 
@@ -127,7 +446,9 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Example ML/GNN usage of grain graph data")
     parser.add_argument("--file", "-f", default="NormalGG_output.h5", help="HDF5 file path")
     parser.add_argument("--timestep", "-t", type=int, default=0, help="Timestep to load")
-    parser.add_argument("--export", action="store_true", help="Export to CSV files")
+    parser.add_argument("--export", action="store_true", help="Export to Parquet (or .npy) files")
+    parser.add_argument("--prefetch", action="store_true", help="Iterate over all timesteps with the prefetching loader")
+    parser.add_argument("--dataloader", action="store_true", help="Iterate over all timesteps in batches with a PyG DataLoader")
     args = parser.parse_args()
     
     h5_file = args.file
@@ -139,12 +460,12 @@ if __name__ == "__main__":
     print(f"Loading graph data from: {h5_file}")
     print(f"Timestep: {args.timestep}\n")
     
-    # 基础数据加载
-    data = load_graph_data(h5_file, args.timestep)
+    # 基础信息（只读取元数据）
+    num_nodes, num_edges = read_graph_sizes(h5_file, args.timestep)
     print(f"[Basic Info]")
-    print(f"  - Number of nodes (grains): {data['num_nodes']}")
-    print(f"  - Number of edges (connections): {data['num_edges']}")
-    print(f"  - Average degree: {data['num_edges'] / data['num_nodes']:.2f}")
+    print(f"  - Number of nodes (grains): {num_nodes}")
+    print(f"  - Number of edges (connections): {num_edges}")
+    print(f"  - Average degree: {num_edges / num_nodes:.2f}")
     
     # NetworkX示例
     example_networkx_usage(h5_file, args.timestep)
@@ -152,6 +473,14 @@ if __name__ == "__main__":
     # PyTorch Geometric示例
     example_pytorch_geometric_usage(h5_file, args.timestep)
     
+    # 多时间步预取示例
+    if args.prefetch:
+        example_prefetch_usage(h5_file)
+    
+    # 多时间步批处理示例
+    if args.dataloader:
+        example_dataloader_usage(h5_file)
+    
     # 导出选项
     if args.export:
         example_save_for_external_tools(h5_file, args.timestep)
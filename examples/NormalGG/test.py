@@ -1,4 +1,5 @@
 import h5py
+import numpy as np
 import argparse
 from pathlib import Path
 
@@ -20,17 +21,23 @@ def read_grain_connections(h5_file, timestep):
             raise ValueError(f"Dataset {dataset_path} not found in HDF5 file.")
         
         # 读取数据
-        data = f[dataset_path][:]
+        data = np.asarray(f[dataset_path][:], dtype=np.int32)
     
-    # 解析扁平化数据
-    grain_connections = {}
+    # 解析扁平化数据：只逐个跳过每个晶粒的头部 [晶粒ID, 邻居数量]
+    starts = []
     i = 0
     while i < len(data):
-        grain_id = int(data[i])  # 当前晶粒ID
-        neighbor_count = int(data[i + 1])  # 邻居数量
-        neighbors = [int(data[i + 2 + j]) for j in range(neighbor_count)]  # 邻居ID列表
-        grain_connections[grain_id] = neighbors
-        i += 2 + neighbor_count  # 跳到下一个晶粒的数据
+        starts.append(i)
+        i += 2 + int(data[i + 1])  # 跳到下一个晶粒的数据
+    starts = np.asarray(starts, dtype=np.int64)
+    
+    grain_ids = data[starts]  # 晶粒ID
+    neighbor_counts = data[starts + 1]  # 邻居数量
+    is_neighbor = np.ones(len(data), dtype=bool)
+    is_neighbor[starts] = False
+    is_neighbor[starts + 1] = False
+    neighbors = np.split(data[is_neighbor], np.cumsum(neighbor_counts)[:-1])  # 邻居ID列表
+    grain_connections = dict(zip(grain_ids.tolist(), (n.tolist() for n in neighbors)))
     
     return grain_connections
 
@@ -5,8 +5,14 @@
 import h5py
 import numpy as np
 import argparse
+from itertools import chain
 from pathlib import Path
 
+try:
+    import hdf5plugin  # noqa: F401  注册 Blosc2 等过滤器，读取 compression="blosc2" 写出的文件
+except ImportError:  # hdf5plugin 为可选依赖
+    pass
+
 def list_available_timesteps(h5_file: str, dataset_name: str = "EdgeIndex"):
     """列出可用的时间步"""
     with h5py.File(h5_file, 'r') as f:
@@ -15,6 +21,13 @@ def list_available_timesteps(h5_file: str, dataset_name: str = "EdgeIndex"):
             raise ValueError(f"Group {grp} not found in HDF5 file: {h5_file}")
         return sorted(int(k) for k in f[grp].keys())
 
+def _read_dataset(dset, dtype=None):
+    """用 read_direct 将数据集直接读入预分配的数组"""
+    buf = np.empty(dset.shape, dtype=dset.dtype if dtype is None else dtype)
+    if buf.size:
+        dset.read_direct(buf)
+    return buf
+
 def read_edge_index(h5_file: str, timestep: int):
     """
     读取EdgeIndex (row, col) 格式
@@ -28,10 +41,11 @@ def read_edge_index(h5_file: str, timestep: int):
         if row_path not in f or col_path not in f:
             raise ValueError(f"EdgeIndex datasets not found at timestep {timestep}")
         
-        row = f[row_path][:]
-        col = f[col_path][:]
+        # 直接读入预分配的 int32 数组，由HDF5完成类型转换
+        row = _read_dataset(f[row_path], dtype=np.int32)
+        col = _read_dataset(f[col_path], dtype=np.int32)
     
-    return row.astype(int), col.astype(int)
+    return row, col
 
 def read_grain_connections(h5_file: str, timestep: int):
     """
@@ -41,16 +55,23 @@ def read_grain_connections(h5_file: str, timestep: int):
         dataset_path = f"/CheckPoints/GrainConnections/{timestep}"
         if dataset_path not in f:
             raise ValueError(f"Dataset {dataset_path} not found in HDF5 file.")
-        data = f[dataset_path][:]
+        data = np.asarray(f[dataset_path][:], dtype=np.int32)
     
-    grain_connections = {}
+    # 只逐个跳过每个晶粒的头部 [grain_id, neighbor_count]，邻居ID整体切分
+    starts = []
     i = 0
     while i < len(data):
-        grain_id = int(data[i])
-        neighbor_count = int(data[i + 1])
-        neighbors = [int(data[i + 2 + j]) for j in range(neighbor_count)]
-        grain_connections[grain_id] = neighbors
-        i += 2 + neighbor_count
+        starts.append(i)
+        i += 2 + int(data[i + 1])
+    starts = np.asarray(starts, dtype=np.int64)
+    
+    grain_ids = data[starts]
+    neighbor_counts = data[starts + 1]
+    is_neighbor = np.ones(len(data), dtype=bool)
+    is_neighbor[starts] = False
+    is_neighbor[starts + 1] = False
+    neighbors = np.split(data[is_neighbor], np.cumsum(neighbor_counts)[:-1])
+    grain_connections = dict(zip(grain_ids.tolist(), (n.tolist() for n in neighbors)))
     
     return grain_connections
 
@@ -59,17 +80,42 @@ def verify_edge_index_consistency(grain_connections: dict, edge_row: np.ndarray,
     验证EdgeIndex和GrainConnections的一致性
     对于无向图，应该有 (i,j) 当且仅当有 (j,i)
     """
-    # 从edge_index构建邻接表
-    edge_adjacency = {}
-    for src, dst in zip(edge_row, edge_col):
-        if src not in edge_adjacency:
-            edge_adjacency[src] = []
-        edge_adjacency[src].append(dst)
+    edge_row = np.asarray(edge_row)
+    edge_col = np.asarray(edge_col)
+    
+    # 将GrainConnections展开为 (src, dst)
+    grain_ids = np.fromiter(grain_connections.keys(), dtype=np.int64, count=len(grain_connections))
+    neighbor_counts = np.fromiter((len(n) for n in grain_connections.values()), dtype=np.int64, count=len(grain_connections))
+    ref_row = np.repeat(grain_ids, neighbor_counts)
+    ref_col = np.fromiter(chain.from_iterable(grain_connections.values()), dtype=np.int64, count=int(neighbor_counts.sum()))
+    
+    # 两者都按 (src, dst) 排序，每个源节点的邻居为连续的一段
+    # 用 src * n + dst 合成一个 int64 键做一次 argsort，比对两列做 lexsort 快一个数量级
+    n = 1 + max((int(a.max()) for a in (edge_row, edge_col, ref_row, ref_col) if a.size), default=0)
+    order = np.argsort(edge_row.astype(np.int64) * n + edge_col)
+    sorted_row = edge_row[order]
+    sorted_col = edge_col[order]
+    ref_order = np.argsort(ref_row * n + ref_col)
+    
+    # 整体比较（只考虑GrainConnections中出现的晶粒）
+    keep = np.isin(sorted_row, grain_ids)
+    if (np.array_equal(sorted_row[keep], ref_row[ref_order])
+            and np.array_equal(sorted_col[keep], ref_col[ref_order])):
+        return True
+    
+    # 存在不一致时逐晶粒定位
+    unique_src, starts, counts = np.unique(sorted_row, return_index=True, return_counts=True)
+    pos = np.searchsorted(unique_src, grain_ids)
+    found = pos < len(unique_src)
+    found[found] = unique_src[pos[found]] == grain_ids[found]
     
-    # 检查一致性
     all_consistent = True
-    for grain_id, neighbors in grain_connections.items():
-        edge_neighbors = sorted(edge_adjacency.get(grain_id, []))
+    for k, (grain_id, neighbors) in enumerate(grain_connections.items()):
+        if found[k]:
+            start = starts[pos[k]]
+            edge_neighbors = sorted_col[start:start + counts[pos[k]]].tolist()
+        else:
+            edge_neighbors = []
         grain_neighbors = sorted(neighbors)
         
         if edge_neighbors != grain_neighbors: